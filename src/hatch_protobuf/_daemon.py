@@ -0,0 +1,270 @@
+"""A long-lived helper process for running protoc.
+
+Each build normally imports grpc_tools and runs protoc in-process. When many builds are
+run one after the other (eg: in a test suite), setting ``HATCH_PROTOBUF_DAEMON=1``
+makes them share a helper process that has already imported grpc_tools instead.
+
+The helper listens on a Unix socket that only the current user can access, and exits
+after it has been idle for a while. Requests and responses are single lines of JSON.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+# how long the daemon waits for a request before exiting, in seconds
+IDLE_TIMEOUT = 600
+# how long to wait for a newly-started daemon to accept connections, in seconds
+START_TIMEOUT = 10
+
+
+def socket_dir() -> Path:
+    """The directory containing this user's daemon sockets."""
+    return Path(tempfile.gettempdir()) / f"hatch-protobuf-{os.getuid()}"
+
+
+def socket_path() -> Path:
+    """The socket for the daemon belonging to this user and Python environment."""
+    # different environments may have different versions of grpc_tools or plugins,
+    # and a daemon must not outlive changes to the code it runs
+    env_id = hashlib.sha256(sys.executable.encode())
+    for module in (__file__, os.path.join(os.path.dirname(__file__), "plugin.py")):
+        env_id.update(str(os.stat(module).st_mtime_ns).encode())
+    return socket_dir() / env_id.hexdigest()[:16]
+
+
+def run_protoc(cwd: str, args: List[str]) -> Optional[int]:
+    """Run protoc in the daemon, starting it if necessary.
+
+    Returns protoc's exit code, or None if the daemon could not be used.
+    """
+    if os.name != "posix":
+        return None
+
+    path = socket_path()
+    if not _make_private_dir(path.parent):
+        return None
+    request = {"cwd": cwd, "args": args, "env": dict(os.environ)}
+    try:
+        sock = _connect(path)
+    except OSError:
+        if not _start(path):
+            return None
+        try:
+            sock = _connect(path)
+        except OSError:
+            return None
+
+    with sock, sock.makefile("rwb") as fobj:
+        fobj.write(json.dumps(request).encode() + b"\n")
+        fobj.flush()
+        line = fobj.readline()
+    if not line:
+        return None
+    response = json.loads(line)
+    sys.stderr.write(response["stderr"])
+    return response["returncode"]
+
+
+def stop(path: Path) -> None:
+    """Ask the daemon listening on ``path`` to exit, if there is one."""
+    if not _is_private_dir(path.parent):
+        return
+    try:
+        sock = _connect(path)
+    except OSError:
+        return
+    with sock, sock.makefile("rwb") as fobj:
+        fobj.write(json.dumps({"stop": True}).encode() + b"\n")
+        fobj.flush()
+        fobj.readline()
+
+
+def _is_private_dir(path: Path) -> bool:
+    """Check that only the current user can access a directory.
+
+    Otherwise, someone else could be listening on a socket in it.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode)  # and not a symlink
+        and st.st_uid == os.getuid()
+        and stat.S_IMODE(st.st_mode) & 0o077 == 0
+    )
+
+
+def _make_private_dir(path: Path) -> bool:
+    """Create a directory only the current user can access, if necessary.
+
+    Returns False if it exists but cannot be trusted.
+    """
+    try:
+        path.mkdir(mode=0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    return _is_private_dir(path)
+
+
+def _connect(path: Path) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _start(path: Path) -> bool:
+    """Start the daemon, unless another process already has, and wait for it."""
+    import fcntl
+
+    # only one process at a time should start a daemon for this path
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            _connect(path).close()
+            return True  # started while we waited for the lock
+        except OSError:
+            pass
+
+        try:
+            # left behind by a daemon that did not exit cleanly
+            old_socket: Optional[int] = path.stat().st_ino
+        except FileNotFoundError:
+            old_socket = None
+        # the daemon forks, so that it is not left as a child of this process
+        process = subprocess.Popen(
+            [sys.executable, "-m", __name__, str(path)],
+            cwd="/",
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        if process.wait() != 0:
+            return False
+
+        # the daemon only moves its socket into place once it is listening
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                if path.stat().st_ino != old_socket:
+                    return True
+            except FileNotFoundError:
+                pass
+            time.sleep(0.05)
+    return False
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            # a client checking whether the daemon is running
+            return
+        request = json.loads(line)
+        if request.get("stop"):
+            self.server.stopping = True  # type: ignore[attr-defined]
+            self.wfile.write(b"{}\n")
+            return
+
+        # protoc and its plugins should see the same environment as they would if
+        # they were run by the build itself (eg: PATH, to find the plugins)
+        old_environ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(request["env"])
+        try:
+            returncode, output = self._run_protoc(request["cwd"], request["args"])
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+
+        response = {"returncode": returncode, "stderr": output}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    @staticmethod
+    def _run_protoc(cwd: str, args: List[str]) -> Tuple[int, str]:
+        """Run protoc, returning its exit code and what it wrote to stderr."""
+        from .plugin import _protoc_main
+
+        # protoc writes errors directly to file descriptor 2, so capture that
+        sys.stderr.flush()
+        old_stderr = os.dup(2)
+        with tempfile.TemporaryFile() as stderr:
+            os.dup2(stderr.fileno(), 2)
+            try:
+                returncode = _protoc_main(cwd, args)
+            except Exception as e:
+                print(f"hatch-protobuf daemon: {e}", file=sys.stderr)
+                returncode = 1
+            finally:
+                sys.stderr.flush()
+                os.dup2(old_stderr, 2)
+                os.close(old_stderr)
+            stderr.seek(0)
+            return returncode, stderr.read().decode(errors="replace")
+
+
+class _Server(socketserver.UnixStreamServer):
+    timeout = IDLE_TIMEOUT
+    stopping = False
+
+    def handle_timeout(self) -> None:
+        self.stopping = True
+
+
+def _exit(signum: int, frame: Any) -> None:
+    raise SystemExit(128 + signum)
+
+
+def main(path: str) -> None:
+    # detach from the process that started this one (see _start)
+    if os.fork() != 0:
+        os._exit(0)
+
+    # import this now, rather than when the first request arrives
+    import grpc_tools.protoc  # type: ignore  # noqa: F401
+
+    os.umask(0o077)
+    # make sure the socket is removed if the daemon is killed
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGHUP, _exit)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with _Server(tmp_path, _Handler) as server:
+        # clients take the socket existing to mean the daemon is ready
+        os.replace(tmp_path, path)
+        bound = os.stat(path)
+        try:
+            # requests are handled one at a time, as protoc changes directory
+            while not server.stopping:
+                server.handle_request()
+        finally:
+            # only remove the socket if it has not been replaced by another daemon's
+            # (the directory may also have been removed, eg: by a test)
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                pass
+            else:
+                if (current.st_dev, current.st_ino) == (bound.st_dev, bound.st_ino):
+                    os.unlink(path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -1,13 +1,121 @@
+import hashlib
+import importlib.metadata
+import json
+import os
 import shlex
+import shutil
 import subprocess
 import sys
-from dataclasses import dataclass
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from functools import cached_property
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
 
 from hatchling.builders.hooks.plugin.interface import BuildHookInterface
 
+# how to run protoc in a subprocess
+_PROTOC_COMMAND = (sys.executable, "-m", "grpc_tools.protoc")
+# pass arguments to protoc in a file if there are more than this many
+_MAX_PROTOC_ARGS = 128
+# only run protoc on separate packages in parallel if at least two of them have this
+# many .proto files; otherwise starting the extra processes costs more than it saves
+_MIN_PARALLEL_GROUP_SIZE = 50
+
+
+def _config_error(value: Any, name: str, expected: str) -> Exception:
+    if value is None:
+        return ValueError(f"Option `{name}` of the protobuf build hook is required")
+    return TypeError(f"Option `{name}` of the protobuf build hook must be {expected}")
+
+
+def _get_bool(config: Dict[str, Any], key: str, default: bool) -> bool:
+    value = config.get(key, default)
+    if not isinstance(value, bool):
+        raise _config_error(value, key, "a boolean")
+    return value
+
+
+def _get_str(
+    config: Dict[str, Any], key: str, default: Optional[str], name: str = ""
+) -> str:
+    value = config.get(key, default)
+    if not isinstance(value, str):
+        raise _config_error(value, name or key, "a string")
+    return value
+
+
+def _get_list(
+    config: Dict[str, Any],
+    key: str,
+    default: Optional[List[Any]],
+    item_type: type,
+    description: str,
+    name: str = "",
+) -> List[Any]:
+    value = config.get(key, default)
+    if not isinstance(value, list) or not all(
+        isinstance(item, item_type) for item in value
+    ):
+        raise _config_error(value, name or key, f"an array of {description}")
+    return value
+
+
+def _protoc_main(cwd: str, args: List[str]) -> int:
+    """Run protoc in-process from the given directory, returning its exit code.
+
+    Raises ImportError if grpc_tools is not available.
+    """
+    from grpc_tools import protoc  # type: ignore
+
+    # `python -m grpc_tools.protoc` adds this so the well-known types can be found
+    proto_include = os.path.join(os.path.dirname(protoc.__file__), "_proto")
+    argv = ["grpc_tools.protoc", *args, f"-I{proto_include}"]
+    old_cwd = os.getcwd()
+    os.chdir(cwd)
+    try:
+        return protoc.main(argv)
+    finally:
+        os.chdir(old_cwd)
+
+
+def _distribution_version(name: str) -> str:
+    """The installed version of a distribution, or "" if it is not installed."""
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return ""
+
+
+def _write_json(path: Path, data: Any) -> None:
+    """Atomically write a JSON file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as fobj:
+        json.dump(data, fobj)
+    os.replace(tmp_path, path)
+
+
+def _is_init(path: Path) -> bool:
+    """Check whether ``path`` is a package (ie: it contains an ``__init__.py`` file)."""
+    return (path / "__init__.py").is_file()
+
+
+def _compile_output_template(template: str) -> str:
+    """Turn an output path template into a format string.
+
+    Any braces other than those of the ``{proto_name}`` and ``{proto_path}``
+    placeholders are escaped, so that they are output unchanged.
+    """
+    return (
+        template.replace("{", "{{")
+        .replace("}", "}}")
+        .replace("{{proto_name}}", "{proto_name}")
+        .replace("{{proto_path}}", "{proto_path}")
+    )
+
 
 @dataclass
 class Generator:
@@ -22,11 +130,23 @@ class Generator:
     """Where to write output files."""
     output_path: Path
 
+    """``outputs`` converted to format strings, so they can be expanded quickly."""
+    output_formats: List[str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.output_formats = [_compile_output_template(o) for o in self.outputs]
+
 
 @dataclass
 class Files:
     inputs: List[Path]
+    # the same as inputs, as passed to protoc
+    input_strs: List[str]
     outputs: List[Path]
+    # outputs split up by generator, in the same order as the generators
+    generator_outputs: List[List[Path]]
+    # inputs partitioned by top-level package; these can be processed independently
+    groups: List[List[str]]
 
 
 class ProtocHook(BuildHookInterface):
@@ -37,33 +157,281 @@ class ProtocHook(BuildHookInterface):
             # nothing to do
             return
 
+        cache = self._load_cache()
+        # the mtimes say nothing about changes to the configuration or the tools
+        if cache.get("config") == self._config_digest and self._outputs_up_to_date():
+            dirty = []
+        else:
+            # only run the generators whose outputs are missing or out of date
+            digests = cache.get("generators", [])
+            dirty = [
+                generator
+                for i, (generator, outputs) in enumerate(
+                    zip(self._generators, self._files.generator_outputs)
+                )
+                if not self._generator_is_up_to_date(i, outputs, digests)
+            ]
+        if not dirty:
+            self.app.display_info("Protobuf outputs up-to-date")
+            build_data["artifacts"] += [p.as_posix() for p in self._files.outputs]
+            return
+
         self.app.display_info("Generating code from Protobuf files")
 
-        args = [
-            sys.executable,
-            "-m",
-            "grpc_tools.protoc",
-        ]
+        args = []
         for path in self._proto_paths:
             args.append("--proto_path")
             args.append(path)
-        for generator in self._generators:
+        for generator in dirty:
             args.append(f"--{generator.name}_out={generator.output_path}")
 
-        args += [str(p) for p in self._files.inputs]  # cast to str for debug output
-
-        self.app.display_debug(f"Running {shlex.join(args)}")
-        subprocess.run(args, cwd=self._root_path, check=True)
+        groups = self._files.groups
+        if not self._run_in_parallel(groups):
+            self._run_protoc(args + self._files.input_strs)
+        else:
+            # the in-process compiler (and the daemon) changes directory, so it cannot
+            # be run from multiple threads
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = [
+                    executor.submit(self._run_protoc_subprocess, args + group)
+                    for group in groups
+                ]
+                for future in futures:
+                    future.result()
+        self._make_data_dir()
+        self._write_cache()
+        self._write_state()
 
         build_data["artifacts"] += [p.as_posix() for p in self._files.outputs]
 
     def clean(self, versions: List[str]) -> None:
-        if not self._files.outputs:
+        # avoid searching for the input files again if we know what we generated
+        outputs = self._load_state()
+        if outputs is None:
+            outputs = self._files.outputs
+        if not outputs:
             # nothing to do
             return
 
-        for output in self._files.outputs:
-            (self._root_path / output).unlink(missing_ok=True)
+        # list each directory once, rather than trying to remove every file
+        root_path = str(self._root_path)
+        by_dir: DefaultDict[str, Set[str]] = defaultdict(set)
+        for output in outputs:
+            dir_path, name = os.path.split(output)
+            by_dir[dir_path].add(name)
+        for dir_path, names in by_dir.items():
+            try:
+                with os.scandir(os.path.join(root_path, dir_path)) as it:
+                    to_remove = [entry.path for entry in it if entry.name in names]
+            except FileNotFoundError:
+                continue
+            for path in to_remove:
+                os.unlink(path)
+
+    @staticmethod
+    def _run_in_parallel(groups: List[List[str]]) -> bool:
+        """Check whether it is worth running protoc on each group in a subprocess."""
+        if (os.cpu_count() or 1) == 1:
+            return False
+        large_groups = [g for g in groups if len(g) >= _MIN_PARALLEL_GROUP_SIZE]
+        return len(large_groups) >= 2
+
+    def _run_protoc(self, args: List[str]) -> None:
+        """Run protoc with the given arguments from the root directory.
+
+        This is done in-process, to avoid the cost of starting a new Python
+        interpreter and importing grpc_tools. If HATCH_PROTOBUF_DAEMON=1 is
+        set, a long-lived helper process is used instead (see ``_daemon``).
+        """
+        if os.environ.get("HATCH_PROTOBUF_DAEMON") == "1":
+            from . import _daemon
+
+            self.app.display_debug(f"Running protoc {shlex.join(args)} in daemon")
+            returncode = _daemon.run_protoc(str(self._root_path), args)
+            if returncode is not None:
+                if returncode != 0:
+                    raise subprocess.CalledProcessError(returncode, ["protoc", *args])
+                return
+            self.app.display_debug("Could not start daemon")
+
+        self.app.display_debug(f"Running protoc {shlex.join(args)}")
+        returncode = _protoc_main(str(self._root_path), args)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ["protoc", *args])
+
+    def _run_protoc_subprocess(self, args: List[str]) -> None:
+        """Run protoc with the given arguments in a new process."""
+        if len(args) <= _MAX_PROTOC_ARGS:
+            cmd = [*_PROTOC_COMMAND, *args]
+            self.app.display_debug(f"Running {shlex.join(cmd)}")
+            self._run_subprocess(cmd)
+            return
+
+        # avoid hitting command line length limits: protoc will read arguments (one
+        # per line) from a file passed as "@<filename>"
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".args", delete=False
+        ) as args_file:
+            args_file.write("\n".join(args) + "\n")
+        try:
+            cmd = [*_PROTOC_COMMAND, f"@{args_file.name}"]
+            self.app.display_debug(f"Running {shlex.join(cmd)}")
+            self.app.display_debug(f"Arguments: {shlex.join(args)}")
+            self._run_subprocess(cmd)
+        finally:
+            os.unlink(args_file.name)
+
+    def _run_subprocess(self, cmd: List[str]) -> None:
+        """Run a command from the root directory, raising an error if it fails."""
+        # protoc doesn't read from stdin, and doesn't care about the other file
+        # descriptors we have open, so don't spend time setting those up
+        subprocess.run(
+            cmd,
+            cwd=self._root_path,
+            check=True,
+            close_fds=False,
+            stdin=subprocess.DEVNULL,
+        )
+
+    def _outputs_up_to_date(self) -> bool:
+        """Check whether every output file is newer than every input file."""
+        try:
+            root_path = str(self._root_path)
+            newest_in = max(
+                os.stat(os.path.join(root_path, p)).st_mtime
+                for p in self._files.input_strs
+            )
+            oldest_out = min(
+                (self._root_path / p).stat().st_mtime for p in self._files.outputs
+            )
+        except FileNotFoundError:
+            # at least one output is missing
+            return False
+        return oldest_out >= newest_in
+
+    def _generator_is_up_to_date(
+        self, index: int, outputs: List[Path], digests: List[str]
+    ) -> bool:
+        """Check whether a generator's outputs were generated from identical inputs.
+
+        This catches the case where the mtimes of the inputs have changed (eg: by
+        switching git branches) but their contents have not.
+        """
+        # generators are identified by position, as several can have the same name
+        if index >= len(digests) or digests[index] != self._generator_digests[index]:
+            return False
+        return all((self._root_path / p).is_file() for p in outputs)
+
+    def _load_cache(self) -> Dict[str, Any]:
+        """Load the digests of the configuration and inputs of the last build."""
+        try:
+            with open(self._cache_path) as fobj:
+                cache = json.load(fobj)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or not isinstance(cache.get("generators"), list):
+            # not written by this version of hatch-protobuf
+            return {}
+        return cache
+
+    def _write_cache(self) -> None:
+        """Record the digests of what the outputs were generated from."""
+        cache = {
+            "config": self._config_digest,
+            "generators": self._generator_digests,
+        }
+        _write_json(self._cache_path, cache)
+
+    def _load_state(self) -> Optional[List[Path]]:
+        """Load the list of output files written by the last build, if known."""
+        try:
+            with open(self._state_path) as fobj:
+                state = json.load(fobj)
+        except (OSError, ValueError):
+            return None
+        outputs = state.get("outputs") if isinstance(state, dict) else None
+        if not isinstance(outputs, list) or not all(
+            isinstance(p, str) for p in outputs
+        ):
+            # not written by this version of hatch-protobuf
+            return None
+        return [Path(p) for p in outputs]
+
+    def _write_state(self) -> None:
+        """Record the output files, so `clean` does not have to find them."""
+        state = {"outputs": [p.as_posix() for p in self._files.outputs]}
+        _write_json(self._state_path, state)
+
+    def _make_data_dir(self) -> None:
+        """Create the directory for the cache and state files, if needed."""
+        gitignore = self._data_dir / ".gitignore"
+        if not gitignore.is_file():
+            self._data_dir.mkdir(parents=True, exist_ok=True)
+            gitignore.write_text("*\n")
+
+    @cached_property
+    def _data_dir(self) -> Path:
+        # not the build directory, as that is a new temporary directory for each build
+        # by pip; hatchling leaves .hatch directories out of sdists and wheels
+        return self._root_path / ".hatch" / "hatch-protobuf"
+
+    @cached_property
+    def _cache_path(self) -> Path:
+        return self._data_dir / "cache.json"
+
+    @cached_property
+    def _state_path(self) -> Path:
+        return self._data_dir / "state.json"
+
+    @cached_property
+    def _inputs_digest(self) -> bytes:
+        """A hash of the input files and the paths used to find imports."""
+        digest = hashlib.sha256()
+        for path in sorted(self._files.inputs):
+            digest.update(path.as_posix().encode())
+            digest.update((self._root_path / path).read_bytes())
+        digest.update(repr(self._proto_paths).encode())
+        return digest.digest()
+
+    @cached_property
+    def _generator_digests(self) -> List[str]:
+        """Hashes of the input files, and each generator's configuration and tools."""
+        digests = []
+        for generator in self._generators:
+            digest = hashlib.sha256(self._inputs_digest)
+            digest.update(repr(generator).encode())
+            digest.update(self._generator_tools[generator.name].encode())
+            digests.append(digest.hexdigest())
+        return digests
+
+    @cached_property
+    def _config_digest(self) -> str:
+        """A hash of everything other than the input files that affects the outputs.
+
+        This is cheap to compute, as it does not read the input files.
+        """
+        digest = hashlib.sha256(repr(self._proto_paths).encode())
+        for generator in self._generators:
+            digest.update(repr(generator).encode())
+            digest.update(self._generator_tools[generator.name].encode())
+        return digest.hexdigest()
+
+    @cached_property
+    def _generator_tools(self) -> Dict[str, str]:
+        """Identify the versions of the tools each generator uses, by name."""
+        # grpcio-tools provides protoc and its built-in generators
+        protoc_version = _distribution_version("grpcio-tools")
+        tools = {}
+        for generator in self._generators:
+            # plugins are found on PATH, and are usually replaced when upgraded
+            plugin = shutil.which(f"protoc-gen-{generator.name}")
+            if plugin is None:
+                # it's built in to protoc (or missing, and protoc will complain)
+                tools[generator.name] = protoc_version
+            else:
+                mtime = os.stat(plugin).st_mtime_ns
+                tools[generator.name] = f"{protoc_version}:{plugin}:{mtime}"
+        return tools
 
     @cached_property
     def _root_path(self) -> Path:
@@ -72,27 +440,76 @@ class ProtocHook(BuildHookInterface):
     @cached_property
     def _default_proto_path(self) -> str:
         builder = self.build_config.builder
-        for project_name in (
-            builder.normalize_file_name_component(builder.metadata.core.raw_name),
-            builder.normalize_file_name_component(builder.metadata.core.name),
-        ):
+        # these are often the same; use a dict to remove duplicates but keep the order
+        project_names = dict.fromkeys(
+            builder.normalize_file_name_component(name)
+            for name in (builder.metadata.core.raw_name, builder.metadata.core.name)
+        )
+        for project_name in project_names:
             # check this first because that's what the wheel builder does
-            if (self._root_path / project_name / "__init__.py").is_file():
+            if _is_init(self._root_path / project_name):
                 return "."
-            if (self._root_path / "src" / project_name / "__init__.py").is_file():
+            if _is_init(self._root_path / "src" / project_name):
                 return "src"
         return "."
 
+    @cached_property
+    def _config(self) -> Dict[str, Any]:
+        """The hook configuration, with defaults filled in.
+
+        All the options are checked together here, so that a bad value is reported
+        before any work is done.
+        """
+        config = self.config
+        generators = _get_list(config, "generators", [], dict, "tables")
+        return {
+            "generate_grpc": _get_bool(config, "generate_grpc", True),
+            "generate_pyi": _get_bool(config, "generate_pyi", True),
+            # the default path is only worked out if it's needed, as that looks at the
+            # project's files
+            "proto_paths": (
+                [self._default_proto_path]
+                if "proto_paths" not in config
+                else _get_list(config, "proto_paths", None, str, "strings")
+            ),
+            "output_path": (
+                self._default_proto_path
+                if "output_path" not in config
+                else _get_str(config, "output_path", None)
+            ),
+            "generators": [
+                {
+                    "name": _get_str(g, "name", None, f"generators[{i}].name"),
+                    "outputs": _get_list(
+                        g, "outputs", None, str, "strings", f"generators[{i}].outputs"
+                    ),
+                    # None means the same as the hook's output_path
+                    "output_path": (
+                        None
+                        if "output_path" not in g
+                        else _get_str(
+                            g, "output_path", None, f"generators[{i}].output_path"
+                        )
+                    ),
+                }
+                for i, g in enumerate(generators)
+            ],
+        }
+
     @cached_property
     def _proto_paths(self) -> List[str]:
-        return self.config.get("proto_paths", [self._default_proto_path])
+        # drop duplicates, so protoc doesn't search the same directory twice
+        paths: Dict[str, str] = {}
+        for path in self._config["proto_paths"]:
+            paths.setdefault(os.path.realpath(self._root_path / path), path)
+        return list(paths.values())
 
     @cached_property
     def _generators(self) -> List[Generator]:
-        gen_grpc = self.config.get("generate_grpc", True)
-        gen_pyi = self.config.get("generate_pyi", True)
+        gen_grpc = self._config["generate_grpc"]
+        gen_pyi = self._config["generate_pyi"]
 
-        output_path = self.config.get("output_path", self._default_proto_path)
+        output_path = self._config["output_path"]
 
         generators = [
             Generator(
@@ -118,12 +535,14 @@ class ProtocHook(BuildHookInterface):
                 )
             )
 
-        for g in self.config.get("generators", []):
+        for g in self._config["generators"]:
             generators.append(
                 Generator(
                     name=g["name"],
                     outputs=g["outputs"],
-                    output_path=Path(g.get("output_path", output_path)),
+                    output_path=Path(
+                        output_path if g["output_path"] is None else g["output_path"]
+                    ),
                 )
             )
 
@@ -132,27 +551,60 @@ class ProtocHook(BuildHookInterface):
     @cached_property
     def _files(self) -> Files:
         """Find input .proto files and the output files they will generate."""
-        inputs = []
+        input_strs = []
         rel_inputs = []
-        for path in map(Path, self._proto_paths):
-            abs_path = self._root_path / path
-            for proto in abs_path.glob("**/*.proto"):
-                # keep inputs relative to root directory, so as not to confuse protoc
-                inputs.append(proto.relative_to(self._root_path))
-                rel_inputs.append(proto.relative_to(abs_path))
+        groups: Dict[Tuple[str, str], List[str]] = {}
+        root_path = str(self._root_path)
+        for path in self._proto_paths:
+            abs_path = os.path.join(root_path, path)
+            # only construct Path objects for the files we're interested in
+            for dirpath, _, filenames in os.walk(abs_path):
+                for name in filenames:
+                    if not name.endswith(".proto"):
+                        continue
+                    proto_file = os.path.join(dirpath, name)
+                    # keep inputs relative to root directory, so as not to confuse
+                    # protoc
+                    root_input = os.path.relpath(proto_file, root_path)
+                    rel_input = Path(os.path.relpath(proto_file, abs_path))
+                    input_strs.append(root_input)
+                    rel_inputs.append(rel_input)
+                    package = rel_input.parts[0] if len(rel_input.parts) > 1 else ""
+                    groups.setdefault((path, package), []).append(root_input)
 
         patterns = [
-            (output, g.output_path) for g in self._generators for output in g.outputs
+            (i, output_format.format, str(g.output_path))
+            for i, g in enumerate(self._generators)
+            for output_format in g.output_formats
         ]
 
-        outputs = []
+        # work with strings, and only convert to Path objects at the end
+        output_strs: List[Tuple[int, str]] = []
         for proto in rel_inputs:
             proto_path = str(proto.parent)
             proto_name = str(proto.stem)
-            for pattern, output_path in patterns:
-                output = pattern.replace("{proto_name}", proto_name).replace(
-                    "{proto_path}", proto_path
+            output_strs += [
+                (
+                    i,
+                    os.path.join(
+                        output_path,
+                        format_output(proto_name=proto_name, proto_path=proto_path),
+                    ),
                 )
-                outputs.append(output_path / output)
+                for i, format_output, output_path in patterns
+            ]
+
+        outputs = []
+        generator_outputs: List[List[Path]] = [[] for _ in self._generators]
+        for i, output_str in output_strs:
+            output = Path(output_str)
+            outputs.append(output)
+            generator_outputs[i].append(output)
 
-        return Files(inputs=inputs, outputs=outputs)
+        return Files(
+            inputs=[Path(p) for p in input_strs],
+            input_strs=input_strs,
+            outputs=outputs,
+            generator_outputs=generator_outputs,
+            groups=list(groups.values()),
+        )
@@ -1,18 +1,130 @@
+import atexit
+import os
+import shutil
 import subprocess
-import sys
+import tempfile
+import venv
+from pathlib import Path
+from typing import Optional
+
+import pytest
+from filelock import FileLock
 
 import hatch_protobuf
 
-# Make sure hatch-protobuf is up to date.
-# Do this once here, rather than once per test.
-subprocess.run(
-    [
-        sys.executable,
-        "-m",
-        "pip",
-        "cache",
-        "remove",
-        hatch_protobuf.__name__,
-    ],
-    check=True,
-)
+
+def use_tmpfs() -> None:
+    """Put temporary files in memory, if possible.
+
+    The builds write lots of small files, so this avoids a lot of disk I/O. An
+    explicitly-set TMPDIR is respected. pytest-xdist workers inherit TMPDIR, so they
+    share the controller's directory.
+
+    The directory is removed when the controller process exits.
+    """
+    shm = Path("/dev/shm")
+    if "TMPDIR" in os.environ or not shm.is_dir():
+        return
+    if shutil.disk_usage(shm).free < 1024**3:
+        return
+    tmp_dir = Path(tempfile.mkdtemp(prefix="hatch-protobuf-tests-", dir=shm))
+    os.environ["TMPDIR"] = str(tmp_dir)  # for subprocesses
+    tempfile.tempdir = None  # make tempfile look at TMPDIR again
+    # exit handlers run in reverse order, so registering this before multiprocessing
+    # is imported lets it clean up its own files in here first
+    atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+
+
+use_tmpfs()
+
+ROOT = Path(__file__).parent.parent
+
+
+def shared_tmp_dir(tmp_path_factory: pytest.TempPathFactory, name: str) -> Path:
+    """Create a temporary directory that is shared between pytest-xdist workers."""
+    if "PYTEST_XDIST_WORKER" not in os.environ:
+        return tmp_path_factory.mktemp(name)
+    # all the workers' temporary directories share a parent
+    path = tmp_path_factory.getbasetemp().parent / name
+    path.mkdir(exist_ok=True)
+    return path
+
+
+@pytest.fixture(scope="session")
+def wheel_cache(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """A directory for wheels built during the test session.
+
+    See ``build_wheel_cached`` in test_plugin.py.
+    """
+    return shared_tmp_dir(tmp_path_factory, "wheels")
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--integration",
+        action="store_true",
+        help="Build the test projects in a separate process and virtualenv, rather "
+        "than in-process.",
+    )
+
+
+@pytest.fixture(scope="session")
+def build_python(
+    request: pytest.FixtureRequest, tmp_path_factory: pytest.TempPathFactory
+) -> Optional[Path]:
+    """The Python interpreter of a virtualenv for building the test projects.
+
+    Unless the --integration option is given, this is None, and the test projects are
+    built in-process.
+
+    Everything needed to build the test projects is installed once, so that they can be
+    built without isolation, rather than hatch creating a build environment and
+    installing hatch-protobuf (and everything else) into it for every test.
+    """
+    if not request.config.getoption("--integration"):
+        return None
+
+    env_dir = shared_tmp_dir(tmp_path_factory, "build-env")
+    if os.name == "nt":
+        python = env_dir / "Scripts" / "python.exe"
+    else:
+        python = env_dir / "bin" / "python"
+    ready = env_dir / "ready"
+
+    with FileLock(f"{env_dir}.lock"):
+        if not ready.exists():
+            venv.create(env_dir, clear=True, with_pip=True)
+            # make sure pip does not install a stale build of hatch-protobuf
+            subprocess.run(
+                [python, "-m", "pip", "cache", "remove", hatch_protobuf.__name__],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            subprocess.run(
+                [
+                    python,
+                    "-m",
+                    "pip",
+                    "install",
+                    "--quiet",
+                    "hatchling",
+                    "mypy-protobuf~=3.0",
+                    ROOT,
+                ],
+                check=True,
+            )
+            # pip compiles what it installs, but the first import of everything a
+            # build needs also compiles anything it did not, and warms the OS's file
+            # cache, before the test builds start (perhaps several at once)
+            subprocess.run(
+                [
+                    python,
+                    "-c",
+                    "import grpc_tools.protoc, hatch_protobuf.plugin,"
+                    " hatchling.builders.wheel",
+                ],
+                check=True,
+            )
+            ready.touch()
+    return python
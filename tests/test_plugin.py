@@ -1,15 +1,31 @@
-import importlib.resources
+import functools
+import hashlib
+import multiprocessing
+import os
+import re
+import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
 import textwrap
 import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, Iterator, List, Optional, Set, Union
+
+import pytest
+from filelock import FileLock
+from hatchling.builders.sdist import SdistBuilder
+from hatchling.builders.wheel import WheelBuilder
+
+from hatch_protobuf import _daemon, plugin
 
 ROOT = Path(__file__).parent.parent
 
-PYPROJECT_HEADER = """\
+# everything in a test project's pyproject.toml, up to the hook's options
+PYPROJECT_HEADER = f"""\
 [project]
 name = "test-project"
 version = "0.0.1"
@@ -19,7 +35,13 @@ dependencies = ["grpcio", "protobuf"]
 requires = ["hatchling"]
 build-backend = "hatchling.build"
 
-"""
+[tool.hatch.build.hooks.protobuf]
+dependencies = [
+    "hatch-protobuf @ {ROOT.as_uri()}",
+    # used by the projects with custom generators
+    "mypy-protobuf~=3.0",
+]
+""".encode()
 
 GITIGNORE = """\
 *_pb2.py
@@ -29,52 +51,222 @@ GITIGNORE = """\
 """
 
 
+HELLOWORLD_PROTO = (Path(__file__).parent / "helloworld.proto").read_bytes()
+GOODBYEWORLD_PROTO = HELLOWORLD_PROTO.replace(b"package world;", b"package goodbye;")
+
+
+@functools.lru_cache(maxsize=None)
+def render_pyproject(hook_options: str) -> bytes:
+    """The pyproject.toml for a test project with the given (indented) hook options."""
+    return PYPROJECT_HEADER + textwrap.dedent(hook_options).encode()
+
+
+def write_pyproject(project: Path, hook_options: str = "") -> None:
+    (project / "pyproject.toml").write_bytes(render_pyproject(hook_options))
+
+
+_IMPORT_RE = re.compile(r"^[ \t]*(?:from|import)[ \t]+(\S+)", re.M)
+_STOP_RE = re.compile(r"^[ \t]*(?:def |class |[^\"#\n]* = )", re.M)
+
 COMMON_WHEEL_FILES = [
     "__init__.py",
     "helloworld.proto",
 ]
 
 
-def create_module_dir(path: Path) -> None:
+@pytest.fixture(scope="session")
+def protos(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """A directory of the .proto files used by the tests, to link into projects.
+
+    It also has skeleton projects in its "layouts" subdirectory, for `copy_layout`.
+    """
+    path = tmp_path_factory.mktemp("protos")
+    (path / "helloworld.proto").write_bytes(HELLOWORLD_PROTO)
+    (path / "goodbyeworld.proto").write_bytes(GOODBYEWORLD_PROTO)
+
+    # the .proto files are kept apart from the Python package
+    # NB: the "test_project" subdir is necessary otherwise protoc generates
+    # incorrect code
+    layout = path / "layouts" / "separate_proto_dir"
+    (layout / "src" / "test_project").mkdir(parents=True)
+    (layout / "src" / "test_project" / "__init__.py").touch()
+    (layout / "protos" / "test_project").mkdir(parents=True)
+    add_proto(layout / "protos" / "test_project", path, "helloworld.proto")
+
+    # as above, with another proto path for a different protobuf package
+    layout = path / "layouts" / "multiple_packages"
+    shutil.copytree(
+        path / "layouts" / "separate_proto_dir", layout, copy_function=link_or_copy
+    )
+    (layout / "more_protos" / "test_project").mkdir(parents=True)
+    add_proto(layout / "more_protos" / "test_project", path, "goodbyeworld.proto")
+    return path
+
+
+def link_or_copy(src: Union[str, Path], dst: Union[str, Path]) -> None:
+    """Copy a file, by hard-linking it where possible.
+
+    So ``dst`` must not be modified in place.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        # eg: a different filesystem
+        shutil.copyfile(src, dst)
+
+
+def add_proto(path: Path, protos: Path, name: str) -> None:
+    """Add a .proto file from the ``protos`` fixture to the ``path`` directory."""
+    link_or_copy(protos / name, path / name)
+
+
+def copy_layout(project: Path, protos: Path, name: str) -> None:
+    """Add the files of a skeleton project in the ``protos`` fixture to ``project``."""
+    shutil.copytree(
+        protos / "layouts" / name,
+        project,
+        copy_function=link_or_copy,
+        dirs_exist_ok=True,
+    )
+
+
+def create_module_dir(path: Path, protos: Path) -> None:
     """Create a directory containing __init__.py and the test helloworld.proto."""
     path.mkdir(parents=True)
     (path / "__init__.py").touch()
-    proto = importlib.resources.read_text("tests", "helloworld.proto")
-    (path / "helloworld.proto").write_text(proto)
-
-
-def build_wheel(project: Path) -> None:
-    """Run `hatch build` on the project."""
-    subprocess.run(
-        [
-            sys.executable,
-            "-m",
-            "hatch",
-            "build",
-            ".",
-        ],
+    add_proto(path, protos, "helloworld.proto")
+
+
+def build_env(python: Path) -> Dict[str, str]:
+    """Environment variables for running ``python`` as if its virtualenv was active.
+
+    In particular, this lets protoc find plugins installed in the virtualenv.
+    """
+    env = dict(os.environ)
+    env["PATH"] = os.pathsep.join([str(python.parent), env.get("PATH", "")])
+    return env
+
+
+def run_hatchling(
+    project: Path, python: Path, args: List[str]
+) -> "subprocess.CompletedProcess[str]":
+    """Run ``hatchling build`` on the project in a separate process.
+
+    Only stderr is captured; hatchling's progress output is discarded.
+    """
+    return subprocess.run(
+        [python, "-m", "hatchling", "build", *args],
         cwd=project,
-        check=True,
+        env=build_env(python),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
     )
 
 
+def build_wheel(project: Path, python: Optional[Path]) -> None:
+    """Build a wheel of the project, in the project directory.
+
+    ``python`` should come from the ``build_python`` fixture. If it is None, the wheel
+    is built in-process, using the hatch-protobuf installed in this environment.
+    Otherwise, the project's build dependencies are not installed, so they must be
+    installed in that environment.
+    """
+    if python is None:
+        builder = WheelBuilder(str(project))
+        for _ in builder.build(directory=str(project), versions=["standard"]):
+            pass
+        return
+
+    result = run_hatchling(project, python, ["--target", "wheel", "--directory", "."])
+    assert result.returncode == 0, result.stderr
+
+
+def clean_project(project: Path, python: Optional[Path]) -> None:
+    """Clean the project, in the same way as `build_wheel` builds it."""
+    if python is None:
+        builder = WheelBuilder(str(project))
+        for _ in builder.build(directory=str(project), clean_only=True):
+            pass
+        return
+
+    result = run_hatchling(project, python, ["--clean-only", "--directory", "."])
+    assert result.returncode == 0, result.stderr
+
+
+def project_digest(project: Path) -> str:
+    """Hash the names and contents of all the files in a project."""
+    digest = hashlib.sha256()
+    for path in sorted(p for p in project.rglob("*") if p.is_file()):
+        digest.update(path.relative_to(project).as_posix().encode() + b"\0")
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def build_wheel_cached(
+    project: Path, wheel_cache: Path, python: Optional[Path]
+) -> None:
+    """Build the project, unless an identical project has already been built.
+
+    Either way, the wheel will be put in the same place `build_wheel` would put it.
+    """
+    cached_dir = wheel_cache / project_digest(project)
+    # other pytest-xdist workers may be building the same project
+    with FileLock(f"{cached_dir}.lock"):
+        if not cached_dir.is_dir():
+            build_wheel(project, python)
+            [wheel_path] = list(project.glob("*.whl"))
+            tmp_dir = wheel_cache / f"{cached_dir.name}.tmp"
+            tmp_dir.mkdir()
+            shutil.copy2(wheel_path, tmp_dir)
+            tmp_dir.rename(cached_dir)
+            return
+
+    for wheel_path in cached_dir.iterdir():
+        shutil.copy2(wheel_path, project)
+
+
 def open_wheel(project: Path) -> zipfile.ZipFile:
     """Find a previously-built wheel, and open it."""
-    [wheel_path] = list(project.glob("**/*.whl"))
+    [wheel_path] = list(project.glob("*.whl"))
     return zipfile.ZipFile(wheel_path)
 
 
-def get_module_dir(wheel: zipfile.ZipFile) -> zipfile.Path:
+@dataclass
+class ModuleDir:
+    """The test_project module in a wheel."""
+
+    path: zipfile.Path
+    # the names of the files and directories directly inside the module
+    names: Set[str]
+
+
+def wheel_names_under(wheel: zipfile.ZipFile, prefix: str) -> Set[str]:
+    """The names of the files and directories directly inside ``prefix`` in the wheel.
+
+    ``prefix`` should be empty or end with "/".
+    """
+    names = set()
+    # NameToInfo is the already-parsed central directory, keyed by name
+    for name in wheel.NameToInfo:
+        if name.startswith(prefix) and len(name) > len(prefix):
+            names.add(name[len(prefix) :].partition("/")[0])
+    return names
+
+
+def get_module_dir(wheel: zipfile.ZipFile) -> ModuleDir:
     """Get the test_project module in the wheel.
 
     Also checks that there are no stray top-level files in the wheel.
     """
-    root = zipfile.Path(wheel)
-    assert {p.name for p in root.iterdir()} == {
+    assert wheel_names_under(wheel, "") == {
         "test_project",
         "test_project-0.0.1.dist-info",
     }
-    return root / "test_project"
+    return ModuleDir(
+        zipfile.Path(wheel, "test_project/"),
+        wheel_names_under(wheel, "test_project/"),
+    )
 
 
 def get_imports(file: zipfile.Path) -> List[str]:
@@ -82,253 +274,649 @@ def get_imports(file: zipfile.Path) -> List[str]:
 
     This uses heuristics and may get it wrong, but it's good enough for the tests.
     """
-    lines = file.read_text().splitlines()
-    imports = []
-    for line in lines:
-        line = line.strip()
-        if line.startswith('"') or line.startswith("#"):
-            continue
-        if line.startswith("def ") or line.startswith("class ") or " = " in line:
-            # we've found the start of the actual code
-            break
-
-        words = line.split()
-        try:
-            if words[0] in ("from", "import"):
-                imports.append(words[1])
-        except IndexError:
-            pass
-    return imports
+    text = file.read_text()
+    # stop at the start of the actual code
+    match = _STOP_RE.search(text)
+    stop = match.start() if match else len(text)
+    return _IMPORT_RE.findall(text, 0, stop)
+
+
+def create_builtin_generators_project(
+    project: Path, protos: Path, settings: str
+) -> None:
+    write_pyproject(project, settings)
+    (project / ".gitignore").write_text(GITIGNORE)
+    create_module_dir(project / "test_project", protos)
+
+
+def create_custom_generator_project(
+    project: Path, protos: Path, module_dir: str
+) -> None:
+    write_pyproject(
+        project,
+        """\
+    generate_pyi = false
+
+    [[tool.hatch.build.hooks.protobuf.generators]]
+    name = "mypy"
+    outputs = ["{proto_path}/{proto_name}_pb2.pyi"]
+
+    [[tool.hatch.build.hooks.protobuf.generators]]
+    name = "mypy_grpc"
+    outputs = ["{proto_path}/{proto_name}_pb2_grpc.pyi"]
+    """,
+    )
+    (project / ".gitignore").write_text(GITIGNORE)
+    create_module_dir(project / module_dir, protos)
+
+
+def create_separate_proto_dir_project(project: Path, protos: Path) -> None:
+    write_pyproject(
+        project,
+        """\
+    proto_paths = ["protos"]
+    output_path = "src"
+    """,
+    )
+    (project / ".gitignore").write_text(GITIGNORE)
+    copy_layout(project, protos, "separate_proto_dir")
 
 
-def test_basic_settings():
-    """Check a project using default settings."""
+def create_multiple_packages_project(project: Path, protos: Path) -> None:
+    write_pyproject(
+        project,
+        """\
+    proto_paths = ["protos", "more_protos"]
+    output_path = "src"
+    """,
+    )
+    (project / ".gitignore").write_text(GITIGNORE)
+    copy_layout(project, protos, "multiple_packages")
+
+
+# the test projects that are built by the `wheels` fixture, by name
+PROJECTS: Dict[str, Callable[[Path, Path], None]] = {
+    "basic_settings": functools.partial(create_builtin_generators_project, settings=""),
+    "no_grpc": functools.partial(
+        create_builtin_generators_project, settings="generate_grpc = false\n"
+    ),
+    "no_pyi": functools.partial(
+        create_builtin_generators_project, settings="generate_pyi = false\n"
+    ),
+    "custom_generator": functools.partial(
+        create_custom_generator_project, module_dir="test_project"
+    ),
+    "src_subdir": functools.partial(
+        create_custom_generator_project, module_dir="src/test_project"
+    ),
+    "separate_proto_dir": create_separate_proto_dir_project,
+    "multiple_packages": create_multiple_packages_project,
+}
+
+
+@pytest.fixture(scope="session")
+def wheels(
+    tmp_path_factory: pytest.TempPathFactory,
+    build_python: Optional[Path],
+    wheel_cache: Path,
+    protos: Path,
+) -> Iterator[Dict[str, zipfile.ZipFile]]:
+    """The wheels of all the PROJECTS, by name.
+
+    The projects are built all at once, in parallel. Building in-process changes the
+    current directory, so that needs separate processes rather than threads.
+    """
+    projects_dir = tmp_path_factory.mktemp("projects")
+    projects = {}
+    for name, create_project in PROJECTS.items():
+        projects[name] = projects_dir / name
+        projects[name].mkdir()
+        create_project(projects[name], protos)
+
+    max_workers = min(len(projects), os.cpu_count() or 1)
+    executor: Executor
+    if build_python is None:
+        # forking isn't safe here, as pytest-xdist workers run threads
+        methods = multiprocessing.get_all_start_methods()
+        method = "forkserver" if "forkserver" in methods else "spawn"
+        executor = ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context(method)
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers)
+    with executor:
+        futures = [
+            executor.submit(build_wheel_cached, project, wheel_cache, build_python)
+            for project in projects.values()
+        ]
+        for future in futures:
+            future.result()
+
+    opened = {name: open_wheel(project) for name, project in projects.items()}
+    yield opened
+    for wheel in opened.values():
+        wheel.close()
+
+
+@pytest.mark.parametrize(
+    "name,generated_files",
+    [
+        pytest.param(
+            "basic_settings",
+            {"helloworld_pb2.py", "helloworld_pb2.pyi", "helloworld_pb2_grpc.py"},
+            id="basic_settings",
+        ),
+        pytest.param(
+            "no_grpc",
+            {"helloworld_pb2.py", "helloworld_pb2.pyi"},
+            id="no_grpc",
+        ),
+        pytest.param(
+            "no_pyi",
+            {"helloworld_pb2.py", "helloworld_pb2_grpc.py"},
+            id="no_pyi",
+        ),
+    ],
+)
+def test_builtin_generators(wheels, name, generated_files):
+    """Check a project using default settings, and turning off the optional outputs."""
+    module_dir = get_module_dir(wheels[name])
+
+    assert module_dir.names == {
+        *COMMON_WHEEL_FILES,
+        *generated_files,
+    }
+
+
+def test_custom_generator(wheels):
+    """Check that configurating a custom generator works."""
+    module_dir = get_module_dir(wheels["custom_generator"])
+
+    assert module_dir.names == {
+        *COMMON_WHEEL_FILES,
+        "helloworld_pb2.py",
+        "helloworld_pb2.pyi",
+        "helloworld_pb2_grpc.py",
+        "helloworld_pb2_grpc.pyi",
+    }
+
+
+def test_src_subdir(wheels):
+    """Check that using a 'src' subdirectory works.
+
+    Custom generators are also used to check they also respect the src subdir.
+    """
+    module_dir = get_module_dir(wheels["src_subdir"])
+
+    assert module_dir.names == {
+        *COMMON_WHEEL_FILES,
+        "helloworld_pb2.py",
+        "helloworld_pb2.pyi",
+        "helloworld_pb2_grpc.py",
+        "helloworld_pb2_grpc.pyi",
+    }
+
+    # It's easy to mess up the protoc command line so that protoc thinks the
+    # module is "src.test_project" instead of just "test_project".
+    imports = {
+        name: get_imports(module_dir.path / name)
+        for name in module_dir.names
+        if name.endswith(".py") or name.endswith(".pyi")
+    }
+    assert "test_project" in imports["helloworld_pb2_grpc.py"]
+    assert "test_project.helloworld_pb2" in imports["helloworld_pb2_grpc.pyi"]
+    for name, file_imports in imports.items():
+        for imp in file_imports:
+            assert not imp.startswith("src."), f"{name}: {imp} starts with 'src.'"
+
+
+def test_input_dir_different_from_output_dir(wheels):
+    """Check that specifying different input and output directories works."""
+    module_dir = get_module_dir(wheels["separate_proto_dir"])
+
+    assert module_dir.names == {
+        "__init__.py",
+        # NB: no .proto file!
+        "helloworld_pb2.py",
+        "helloworld_pb2.pyi",
+        "helloworld_pb2_grpc.py",
+    }
+
+
+def test_multiple_packages(wheels):
+    """Check that .proto files in independent packages are all processed."""
+    module_dir = get_module_dir(wheels["multiple_packages"])
+
+    assert module_dir.names == {
+        "__init__.py",
+        "helloworld_pb2.py",
+        "helloworld_pb2.pyi",
+        "helloworld_pb2_grpc.py",
+        "goodbyeworld_pb2.py",
+        "goodbyeworld_pb2.pyi",
+        "goodbyeworld_pb2_grpc.py",
+    }
+
+
+def test_generator_output_path_root(build_python, protos):
+    """Check that a generator's output_path can be the project root.
+
+    An empty output_path is not the same as leaving it out.
+    """
     with tempfile.TemporaryDirectory() as project_dir_str:
         project_dir = Path(project_dir_str)
 
-        with open(project_dir / "pyproject.toml", "w") as fobj:
-            fobj.write(PYPROJECT_HEADER)
-            fobj.write(
-                textwrap.dedent(
-                    f"""\
-                [tool.hatch.build.hooks.protobuf]
-                dependencies = ["hatch-protobuf @ {ROOT.as_uri()}"]
-                """
-                )
-            )
+        write_pyproject(
+            project_dir,
+            """\
+        generate_pyi = false
+
+        [[tool.hatch.build.hooks.protobuf.generators]]
+        name = "mypy"
+        outputs = ["{proto_path}/{proto_name}_pb2.pyi"]
+        output_path = ""
+        """,
+        )
         (project_dir / ".gitignore").write_text(GITIGNORE)
-        create_module_dir(project_dir / "test_project")
+        create_module_dir(project_dir / "src" / "test_project", protos)
+
+        build_wheel(project_dir, build_python)
+        assert (project_dir / "src" / "test_project" / "helloworld_pb2.py").is_file()
+        assert (project_dir / "test_project" / "helloworld_pb2.pyi").is_file()
+        assert not (
+            project_dir / "src" / "test_project" / "helloworld_pb2.pyi"
+        ).exists()
+
+
+def test_parallel_packages(build_python, protos, monkeypatch):
+    """Check that running protoc on independent packages in parallel works."""
+    if build_python is not None:
+        pytest.skip("the thresholds can only be changed for in-process builds")
+    monkeypatch.setattr(plugin, "_MIN_PARALLEL_GROUP_SIZE", 1)
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
+        create_multiple_packages_project(project_dir, protos)
 
-        build_wheel(project_dir)
+        build_wheel(project_dir, build_python)
         with open_wheel(project_dir) as wheel:
             module_dir = get_module_dir(wheel)
 
-            assert {p.name for p in module_dir.iterdir()} == {
-                *COMMON_WHEEL_FILES,
+            assert module_dir.names == {
+                "__init__.py",
                 "helloworld_pb2.py",
                 "helloworld_pb2.pyi",
                 "helloworld_pb2_grpc.py",
+                "goodbyeworld_pb2.py",
+                "goodbyeworld_pb2.pyi",
+                "goodbyeworld_pb2_grpc.py",
             }
 
 
-def test_no_grpc():
-    """Check that turning off the generate_grpc option works."""
+def test_argument_file(build_python, protos, monkeypatch):
+    """Check that long protoc command lines are passed in a file."""
+    if build_python is not None:
+        pytest.skip("the thresholds can only be changed for in-process builds")
+    monkeypatch.setattr(plugin, "_MIN_PARALLEL_GROUP_SIZE", 1)
+    monkeypatch.setattr(plugin, "_MAX_PROTOC_ARGS", 1)
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    commands = []
+    run_subprocess = plugin.ProtocHook._run_subprocess
+
+    def record_subprocess(self, cmd):
+        commands.append(cmd)
+        run_subprocess(self, cmd)
+
+    monkeypatch.setattr(plugin.ProtocHook, "_run_subprocess", record_subprocess)
     with tempfile.TemporaryDirectory() as project_dir_str:
         project_dir = Path(project_dir_str)
+        create_multiple_packages_project(project_dir, protos)
 
-        with open(project_dir / "pyproject.toml", "w") as fobj:
-            fobj.write(PYPROJECT_HEADER)
-            fobj.write(
-                textwrap.dedent(
-                    f"""\
-                [tool.hatch.build.hooks.protobuf]
-                dependencies = ["hatch-protobuf @ {ROOT.as_uri()}"]
-                generate_grpc = false
-                """
-                )
-            )
-        (project_dir / ".gitignore").write_text(GITIGNORE)
-        create_module_dir(project_dir / "test_project")
-
-        build_wheel(project_dir)
+        build_wheel(project_dir, build_python)
+        assert len(commands) == 2
+        assert all(cmd[-1].startswith("@") for cmd in commands)
         with open_wheel(project_dir) as wheel:
             module_dir = get_module_dir(wheel)
 
-            assert {p.name for p in module_dir.iterdir()} == {
-                *COMMON_WHEEL_FILES,
+            assert module_dir.names == {
+                "__init__.py",
                 "helloworld_pb2.py",
                 "helloworld_pb2.pyi",
+                "helloworld_pb2_grpc.py",
+                "goodbyeworld_pb2.py",
+                "goodbyeworld_pb2.pyi",
+                "goodbyeworld_pb2_grpc.py",
             }
 
 
-def test_no_pyi():
-    """Check that turning off the generate_pyi option works."""
+def test_bad_config(build_python, protos):
+    """Check that invalid options are reported."""
     with tempfile.TemporaryDirectory() as project_dir_str:
         project_dir = Path(project_dir_str)
 
-        with open(project_dir / "pyproject.toml", "w") as fobj:
-            fobj.write(PYPROJECT_HEADER)
-            fobj.write(
-                textwrap.dedent(
-                    f"""\
-                [tool.hatch.build.hooks.protobuf]
-                dependencies = ["hatch-protobuf @ {ROOT.as_uri()}"]
-                generate_pyi = false
-                """
-                )
-            )
+        write_pyproject(
+            project_dir,
+            """\
+        proto_paths = "src"
+        """,
+        )
         (project_dir / ".gitignore").write_text(GITIGNORE)
-        create_module_dir(project_dir / "test_project")
+        create_module_dir(project_dir / "test_project", protos)
 
-        build_wheel(project_dir)
-        with open_wheel(project_dir) as wheel:
-            module_dir = get_module_dir(wheel)
+        message = "Option `proto_paths` of the protobuf build hook"
+        if build_python is None:
+            with pytest.raises(TypeError, match=message):
+                build_wheel(project_dir, build_python)
+        else:
+            result = run_hatchling(project_dir, build_python, ["--target", "wheel"])
+            assert result.returncode != 0
+            assert message in result.stderr
 
-            assert {p.name for p in module_dir.iterdir()} == {
-                *COMMON_WHEEL_FILES,
-                "helloworld_pb2.py",
-                "helloworld_pb2_grpc.py",
-            }
 
+@pytest.fixture
+def daemon_sockets(monkeypatch) -> Iterator[Path]:
+    """Enable daemon mode, with a private socket directory.
 
-def test_custom_generator():
-    """Check that configurating a custom generator works."""
+    This means that neither the test nor the build use a daemon left running by
+    something else. Any daemons started by the test are stopped afterwards.
+    """
+    if os.name != "posix":
+        pytest.skip("the daemon is only used on POSIX")
+    monkeypatch.setenv("HATCH_PROTOBUF_DAEMON", "1")
+    with tempfile.TemporaryDirectory() as socket_tmp:
+        monkeypatch.setenv("TMPDIR", socket_tmp)
+        monkeypatch.setattr(tempfile, "tempdir", socket_tmp)
+        sockets = _daemon.socket_dir()
+        try:
+            yield sockets
+        finally:
+            if sockets.is_dir():
+                for path in sockets.iterdir():
+                    _daemon.stop(path)
+
+
+def daemon_was_started(sockets: Path) -> bool:
+    return any(path.suffix == "" for path in sockets.iterdir())
+
+
+def test_daemon(build_python, daemon_sockets, protos):
+    """Check that running protoc in a daemon process works."""
     with tempfile.TemporaryDirectory() as project_dir_str:
         project_dir = Path(project_dir_str)
 
-        with open(project_dir / "pyproject.toml", "w") as fobj:
-            fobj.write(PYPROJECT_HEADER)
-            fobj.write(
-                textwrap.dedent(
-                    f"""\
-                [tool.hatch.build.hooks.protobuf]
-                dependencies = [
-                    "hatch-protobuf @ {ROOT.as_uri()}",
-                    "mypy-protobuf~=3.0",
-                ]
-                generate_pyi = false
-
-                [[tool.hatch.build.hooks.protobuf.generators]]
-                name = "mypy"
-                outputs = ["{{proto_path}}/{{proto_name}}_pb2.pyi"]
-
-                [[tool.hatch.build.hooks.protobuf.generators]]
-                name = "mypy_grpc"
-                outputs = ["{{proto_path}}/{{proto_name}}_pb2_grpc.pyi"]
-                """
-                )
-            )
+        write_pyproject(project_dir)
         (project_dir / ".gitignore").write_text(GITIGNORE)
-        module_dir = project_dir / "test_project"
-        create_module_dir(module_dir)
+        create_module_dir(project_dir / "test_project", protos)
 
-        build_wheel(project_dir)
+        build_wheel(project_dir, build_python)
+        assert daemon_was_started(daemon_sockets)
         with open_wheel(project_dir) as wheel:
             module_dir = get_module_dir(wheel)
 
-            assert {p.name for p in module_dir.iterdir()} == {
+            assert module_dir.names == {
                 *COMMON_WHEEL_FILES,
                 "helloworld_pb2.py",
                 "helloworld_pb2.pyi",
                 "helloworld_pb2_grpc.py",
-                "helloworld_pb2_grpc.pyi",
             }
 
 
-def test_src_subdir():
-    """Check that using a 'src' subdirectory works.
+ENV_PLUGIN = f"""\
+#!{sys.executable}
+import os
+import sys
 
-    Custom generators are also used to check they also respect the src subdir.
-    """
+from google.protobuf.compiler import plugin_pb2
+
+request = plugin_pb2.CodeGeneratorRequest.FromString(sys.stdin.buffer.read())
+response = plugin_pb2.CodeGeneratorResponse()
+for name in request.file_to_generate:
+    output = response.file.add()
+    output.name = name[: -len(".proto")] + ".env"
+    output.content = os.environ.get("HATCH_PROTOBUF_TEST_VALUE", "")
+sys.stdout.buffer.write(response.SerializeToString())
+"""
+
+
+def test_daemon_environment(build_python, daemon_sockets, protos, monkeypatch):
+    """Check that plugins run by the daemon see the build's environment."""
     with tempfile.TemporaryDirectory() as project_dir_str:
         project_dir = Path(project_dir_str)
 
-        with open(project_dir / "pyproject.toml", "w") as fobj:
-            fobj.write(PYPROJECT_HEADER)
-            fobj.write(
-                textwrap.dedent(
-                    f"""\
-                [tool.hatch.build.hooks.protobuf]
-                dependencies = [
-                    "hatch-protobuf @ {ROOT.as_uri()}",
-                    "mypy-protobuf~=3.0",
-                ]
-                generate_pyi = false
-
-                [[tool.hatch.build.hooks.protobuf.generators]]
-                name = "mypy"
-                outputs = ["{{proto_path}}/{{proto_name}}_pb2.pyi"]
-
-                [[tool.hatch.build.hooks.protobuf.generators]]
-                name = "mypy_grpc"
-                outputs = ["{{proto_path}}/{{proto_name}}_pb2_grpc.pyi"]
-                """
-                )
-            )
+        plugin_dir = project_dir / "plugins"
+        plugin_dir.mkdir()
+        (plugin_dir / "protoc-gen-env").write_text(ENV_PLUGIN)
+        (plugin_dir / "protoc-gen-env").chmod(0o755)
+        monkeypatch.setenv("PATH", f"{plugin_dir}{os.pathsep}{os.environ['PATH']}")
+        monkeypatch.setenv("HATCH_PROTOBUF_TEST_VALUE", "from the build")
+
+        write_pyproject(
+            project_dir,
+            """\
+        [[tool.hatch.build.hooks.protobuf.generators]]
+        name = "env"
+        outputs = ["{proto_path}/{proto_name}.env"]
+        """,
+        )
         (project_dir / ".gitignore").write_text(GITIGNORE)
-        module_dir = project_dir / "src" / "test_project"
-        create_module_dir(module_dir)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
 
-        build_wheel(project_dir)
-        with open_wheel(project_dir) as wheel:
-            module_dir = get_module_dir(wheel)
+        build_wheel(project_dir, build_python)
+        assert daemon_was_started(daemon_sockets)
+        assert (module_dir / "helloworld.env").read_text() == "from the build"
 
-            assert {p.name for p in module_dir.iterdir()} == {
-                *COMMON_WHEEL_FILES,
-                "helloworld_pb2.py",
-                "helloworld_pb2.pyi",
-                "helloworld_pb2_grpc.py",
-                "helloworld_pb2_grpc.pyi",
-            }
+        # the daemon is still running, with the environment it was started with
+        monkeypatch.setenv("HATCH_PROTOBUF_TEST_VALUE", "from the next build")
+        (module_dir / "helloworld.env").unlink()
+        build_wheel(project_dir, build_python)
+        assert (module_dir / "helloworld.env").read_text() == "from the next build"
 
-            # It's easy to mess up the protoc command line so that protoc thinks the
-            # module is "src.test_project" instead of just "test_project".
-            for file in module_dir.iterdir():
-                if file.name.endswith(".py") or file.name.endswith(".pyi"):
-                    for imp in get_imports(file):
-                        assert not imp.startswith(
-                            "src."
-                        ), f"{file.name}: {imp} starts with 'src.'"
 
+@pytest.mark.skipif(os.name != "posix", reason="the daemon is only used on POSIX")
+def test_daemon_untrusted_dir(monkeypatch):
+    """Check that the daemon is not used if others can access its socket directory."""
+    with tempfile.TemporaryDirectory() as socket_tmp:
+        monkeypatch.setattr(tempfile, "tempdir", socket_tmp)
+        sockets = _daemon.socket_dir()
+        sockets.mkdir()
+        sockets.chmod(0o777)
 
-def test_input_dir_different_from_output_dir():
-    """Check that specifying different input and output directories works."""
+        assert _daemon.run_protoc(socket_tmp, ["--version"]) is None
+        assert not list(sockets.iterdir())
+
+
+def test_incremental_build(build_python, protos):
+    """Check that protoc is only re-run when the .proto files change."""
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
+
+        write_pyproject(project_dir)
+        (project_dir / ".gitignore").write_text(GITIGNORE)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
+        proto = module_dir / "helloworld.proto"
+        output = module_dir / "helloworld_pb2.py"
+        # this changes the mtime of the .proto file, so it needs its own copy
+        proto.unlink()
+        proto.write_bytes(HELLOWORLD_PROTO)
+
+        build_wheel(project_dir, build_python)
+        first_mtime = output.stat().st_mtime_ns
+
+        # nothing changed, so the outputs should be left alone
+        build_wheel(project_dir, build_python)
+        assert output.stat().st_mtime_ns == first_mtime
+
+        # touching the input without changing it (eg: git checkout) should not
+        # cause the outputs to be regenerated either
+        later = first_mtime + 10**9
+        os.utime(proto, ns=(later, later))
+        build_wheel(project_dir, build_python)
+        assert output.stat().st_mtime_ns == first_mtime
+
+        # only the generator whose output is missing should be re-run
+        stub = module_dir / "helloworld_pb2.pyi"
+        stub.unlink()
+        build_wheel(project_dir, build_python)
+        assert stub.is_file()
+        assert output.stat().st_mtime_ns == first_mtime
+
+        # edit the input (and make sure it is newer, whatever the mtime resolution)
+        proto.write_text(proto.read_text() + "\nmessage Extra {}\n")
+        os.utime(proto, ns=(later, later))
+        build_wheel(project_dir, build_python)
+        assert output.stat().st_mtime_ns != first_mtime
+        assert "_EXTRA" in output.read_text()
+
+
+def test_generators_with_same_name(build_python, protos):
+    """Check that generators with the same name are tracked separately."""
     with tempfile.TemporaryDirectory() as project_dir_str:
         project_dir = Path(project_dir_str)
 
-        with open(project_dir / "pyproject.toml", "w") as fobj:
-            fobj.write(PYPROJECT_HEADER)
-            fobj.write(
-                textwrap.dedent(
-                    f"""\
-                [tool.hatch.build.hooks.protobuf]
-                dependencies = ["hatch-protobuf @ {ROOT.as_uri()}"]
-                proto_paths = ["protos"]
-                output_path = "src"
-                """
-                )
-            )
+        write_pyproject(
+            project_dir,
+            """\
+        generate_pyi = false
+
+        [[tool.hatch.build.hooks.protobuf.generators]]
+        name = "mypy"
+        outputs = ["{proto_path}/{proto_name}_pb2.pyi"]
+
+        [[tool.hatch.build.hooks.protobuf.generators]]
+        name = "mypy"
+        outputs = ["{proto_path}/{proto_name}_pb2.pyi"]
+        output_path = "stubs"
+        """,
+        )
         (project_dir / ".gitignore").write_text(GITIGNORE)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
+        (project_dir / "stubs").mkdir()
+        proto = module_dir / "helloworld.proto"
+        # this changes the mtime of the .proto file, so it needs its own copy
+        proto.unlink()
+        proto.write_bytes(HELLOWORLD_PROTO)
+        outputs = [
+            module_dir / "helloworld_pb2.pyi",
+            project_dir / "stubs" / "test_project" / "helloworld_pb2.pyi",
+        ]
+
+        build_wheel(project_dir, build_python)
+        first_mtimes = [output.stat().st_mtime_ns for output in outputs]
+
+        # touching the input makes the hook compare digests, which should match
+        later = max(first_mtimes) + 10**9
+        os.utime(proto, ns=(later, later))
+        build_wheel(project_dir, build_python)
+        assert [output.stat().st_mtime_ns for output in outputs] == first_mtimes
+
+
+def test_tools_upgraded(build_python, protos, monkeypatch):
+    """Check that the outputs are regenerated if protoc is upgraded."""
+    if build_python is not None:
+        pytest.skip("the version of grpcio-tools can only be faked in-process")
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
 
-        module_dir = project_dir / "src" / "test_project"
-        module_dir.mkdir(parents=True)
-        (module_dir / "__init__.py").touch()
+        write_pyproject(project_dir)
+        (project_dir / ".gitignore").write_text(GITIGNORE)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
+        output = module_dir / "helloworld_pb2.py"
 
-        # NB: the "test_project" subdir is necessary otherwise protoc generates
-        # incorrect code
-        proto_dir = project_dir / "protos" / "test_project"
-        proto = importlib.resources.read_text("tests", "helloworld.proto")
-        proto_dir.mkdir(parents=True)
-        (proto_dir / "helloworld.proto").write_text(proto)
+        build_wheel(project_dir, build_python)
+        first_mtime = output.stat().st_mtime_ns
 
-        build_wheel(project_dir)
-        with open_wheel(project_dir) as wheel:
-            module_dir = get_module_dir(wheel)
+        # the outputs are newer than the inputs, but that's not enough
+        monkeypatch.setattr(plugin, "_distribution_version", lambda name: "999")
+        build_wheel(project_dir, build_python)
+        assert output.stat().st_mtime_ns != first_mtime
 
-            assert {p.name for p in module_dir.iterdir()} == {
-                "__init__.py",
-                # NB: no .proto file!
-                "helloworld_pb2.py",
-                "helloworld_pb2.pyi",
-                "helloworld_pb2_grpc.py",
-            }
+
+def test_cache_location(build_python, protos):
+    """Check that the cache is kept in the project, but not in the sdist."""
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
+
+        write_pyproject(project_dir)
+        (project_dir / ".gitignore").write_text(GITIGNORE)
+        create_module_dir(project_dir / "test_project", protos)
+
+        build_wheel(project_dir, build_python)
+        data_dir = project_dir / ".hatch" / "hatch-protobuf"
+        assert {p.name for p in data_dir.iterdir()} == {
+            ".gitignore",
+            "cache.json",
+            "state.json",
+        }
+        assert (data_dir / ".gitignore").read_text() == "*\n"
+
+        dist_dir = project_dir / "dist"
+        if build_python is None:
+            builder = SdistBuilder(str(project_dir))
+            for _ in builder.build(directory=str(dist_dir), versions=["standard"]):
+                pass
+        else:
+            result = run_hatchling(project_dir, build_python, ["--target", "sdist"])
+            assert result.returncode == 0, result.stderr
+        (sdist_path,) = dist_dir.glob("*.tar.gz")
+        with tarfile.open(sdist_path) as sdist:
+            names = sdist.getnames()
+        assert any(name.endswith("/test_project/helloworld.proto") for name in names)
+        assert not any("/.hatch/" in name for name in names)
+
+
+def test_clean(build_python, protos):
+    """Check that `hatch clean` removes the generated files."""
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
+
+        write_pyproject(project_dir)
+        (project_dir / ".gitignore").write_text(GITIGNORE)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
+
+        build_wheel(project_dir, build_python)
+        assert (module_dir / "helloworld_pb2.py").is_file()
+
+        clean_project(project_dir, build_python)
+        assert {p.name for p in module_dir.iterdir()} == set(COMMON_WHEEL_FILES)
+
+
+@pytest.mark.parametrize("state", ["{}", "[]", '{"outputs": 1}', "{"])
+def test_clean_bad_state(build_python, protos, state):
+    """Check that `hatch clean` still works if the record of the outputs is invalid."""
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
+
+        write_pyproject(project_dir)
+        (project_dir / ".gitignore").write_text(GITIGNORE)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
+
+        build_wheel(project_dir, build_python)
+        state_file = project_dir / ".hatch" / "hatch-protobuf" / "state.json"
+        assert state_file.is_file()
+        state_file.write_text(state)
+
+        clean_project(project_dir, build_python)
+        assert {p.name for p in module_dir.iterdir()} == set(COMMON_WHEEL_FILES)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="creating symlinks may not be allowed")
+def test_symlinked_dir(build_python, protos):
+    """Check that symlinked directories are not searched for .proto files."""
+    with tempfile.TemporaryDirectory() as project_dir_str:
+        project_dir = Path(project_dir_str)
+
+        write_pyproject(project_dir)
+        (project_dir / ".gitignore").write_text(GITIGNORE)
+        module_dir = project_dir / "test_project"
+        create_module_dir(module_dir, protos)
+        # following this would find the same .proto file over and over again
+        (module_dir / "loop").symlink_to(".")
+
+        build_wheel(project_dir, build_python)
+        assert (module_dir / "helloworld_pb2.py").is_file()